@@ -10,20 +10,28 @@ import sys
 import time
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Set up our logger
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger()
 
-REQUIRED_ENVIRONMENT_VARIABLES = ['ENVIRONMENT_NAME', 'VERIFY_TOKEN']
-for env_var in REQUIRED_ENVIRONMENT_VARIABLES:
-    if env_var not in os.environ:
-        logger.error(f'{env_var} is a required environment variable')
-        sys.exit(1)
+REQUIRED_ENVIRONMENT_VARIABLES = frozenset({'ENVIRONMENT_NAME', 'VERIFY_TOKEN'})
+missing = REQUIRED_ENVIRONMENT_VARIABLES - os.environ.keys()
+if missing:
+    logger.error('%s are required environment variables', ', '.join(sorted(missing)))
+    sys.exit(1)
 VERIFY_TOKEN = os.environ['VERIFY_TOKEN']
 ENVIRONMENT_NAME = os.environ['ENVIRONMENT_NAME']
 
+# Create the DynamoDB client once at import so warm Lambda invocations reuse the same HTTPS connection instead of
+# paying for session setup and a TLS handshake on every request. The low-level client skips the resource layer's
+# per-call marshalling and model loading, which matters for a write this small.
+_BOTO_CONFIG = Config(max_pool_connections=10, retries={'max_attempts': 3, 'mode': 'standard'}, tcp_keepalive=True)
+_SESSION = boto3.session.Session()
+_DDB_CLIENT = _SESSION.client('dynamodb', config=_BOTO_CONFIG)
+
 
 def verify_token(event):
     """
@@ -40,28 +48,33 @@ def verify_token(event):
     return False
 
 
-def dynamodb_write(table_name, cluster_name, epoch_seconds):
+def dynamodb_write(cluster_name, epoch_seconds, client=_DDB_CLIENT):
     """
-    Updates the epoch_seconds field in DynamoDB for a cluster so we know when we last heard from it.
+    Updates the epoch_seconds field in DynamoDB for a cluster so we know when we last heard from it. The write is
+    conditional on the stored timestamp actually advancing, so duplicate check-ins within the same second become a
+    cheap conditional-check failure instead of a full write.
 
-    :param table_name: (str) The name of the DynamoDB table to use
     :param cluster_name: (str) The name of the Kubernetes cluster running Prometheus
     :param epoch_seconds: (int) The last time we heard from the cluster in epoch seconds
+    :param client: The low-level DynamoDB client to use, defaults to the module-level handle
     """
-    dynamodb = boto3.resource('dynamodb')
     try:
-        table = dynamodb.Table(table_name)
-        response = table.update_item(
+        response = client.update_item(
+            TableName=ENVIRONMENT_NAME,
             Key={
-                'cluster_name': cluster_name
+                'cluster_name': {'S': cluster_name}
             },
             UpdateExpression="set epoch_seconds=:e",
+            ConditionExpression="attribute_not_exists(epoch_seconds) OR epoch_seconds < :e",
             ExpressionAttributeValues={
-                ':e': epoch_seconds
+                ':e': {'N': str(epoch_seconds)}
             },
             ReturnValues="UPDATED_NEW"
         )
     except ClientError as err:
+        if err.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info('Stored timestamp for %s is already current, skipping write', cluster_name)
+            return None
         logger.critical('DynamoDB Update Encountered an Error')
         logger.critical(err, exc_info=True)
         raise Exception('[InternalServerError] DynamoDB Update Encountered an Error')
@@ -81,9 +94,10 @@ def webhook(event, context):
         return {"statusCode": 400, "body": "Wrong verification token"}
 
     cluster_name = event['path']['cluster_name']
-    epoch_seconds = int(time.time())
-    logger.info(f'Writing record for {cluster_name} with timestamp {epoch_seconds} to DynamoDB')
-    dynamodb_write(ENVIRONMENT_NAME, cluster_name, epoch_seconds)
+    # Integer nanoseconds divided down to whole seconds; second granularity is plenty for a 5 minute staleness check
+    epoch_seconds = time.time_ns() // 1_000_000_000
+    logger.info('Writing record for %s with timestamp %d to DynamoDB', cluster_name, epoch_seconds)
+    dynamodb_write(cluster_name, epoch_seconds)
     return {"statusCode": 200, "body": str(epoch_seconds)}
 
 
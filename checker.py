@@ -5,37 +5,76 @@ Runs on a schedule and sends an alert to slack if any of the Prometheus Clusters
 in for over 5 minutes. Also sets a flag in DynamoDB so a recovery message can be sent.
 
 """
+import json
 import sys
 import time
 import os
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto3
+import urllib3
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 here = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(here, "./vendored"))
-import requests
 from croniter import croniter
 
-# Set up our logger
-logging.basicConfig(level=logging.INFO)
+# Set up our logger. The boto libraries log a lot of boilerplate at INFO, so keep them at WARNING.
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
 logger = logging.getLogger()
+logging.getLogger('boto3').setLevel(logging.WARNING)
+logging.getLogger('botocore').setLevel(logging.WARNING)
 
 
-REQUIRED_ENVIRONMENT_VARIABLES = ['ENVIRONMENT_NAME', 'MAX_TIME_SECONDS', 'SLACK_CHANNEL', 'SLACK_TOKEN']
-for env_var in REQUIRED_ENVIRONMENT_VARIABLES:
-    if env_var not in os.environ:
-        logger.error(f'{env_var} is a required environment variable')
-        sys.exit(1)
+REQUIRED_ENVIRONMENT_VARIABLES = frozenset({'ENVIRONMENT_NAME', 'MAX_TIME_SECONDS', 'SLACK_CHANNEL', 'SLACK_TOKEN'})
+missing = REQUIRED_ENVIRONMENT_VARIABLES - os.environ.keys()
+if missing:
+    logger.error('%s are required environment variables', ', '.join(sorted(missing)))
+    sys.exit(1)
 
 ENVIRONMENT_NAME = os.environ['ENVIRONMENT_NAME']
-MAX_TIME_SECONDS = os.environ['MAX_TIME_SECONDS']
+MAX_TIME_SECONDS = int(os.environ['MAX_TIME_SECONDS'])
 SLACK_CHANNEL = os.environ['SLACK_CHANNEL']
 SLACK_TOKEN = os.environ['SLACK_TOKEN']
-
-SCALE_DOWN_CLUSTERS = []
+TOTAL_SEGMENTS = int(os.environ.get('TOTAL_SEGMENTS', 4))
+
+# Create the DynamoDB handles once at import so warm Lambda invocations reuse the same HTTPS connection instead of
+# paying for session setup and a TLS handshake on every request. The pool is sized so the parallel scan segments
+# don't serialize on HTTPS connections.
+_BOTO_CONFIG = Config(max_pool_connections=max(10, TOTAL_SEGMENTS * 2),
+                      retries={'max_attempts': 3, 'mode': 'standard'}, tcp_keepalive=True)
+_SESSION = boto3.session.Session()
+_DYNAMODB = _SESSION.resource('dynamodb', config=_BOTO_CONFIG)
+_TABLE = _DYNAMODB.Table(ENVIRONMENT_NAME)
+_DDB_CLIENT = _SESSION.client('dynamodb', config=_BOTO_CONFIG)
+_DESERIALIZER = TypeDeserializer()
+
+# Reuse one HTTPS connection to Slack across notifications and warm invocations rather than opening a fresh TLS
+# session per post, with retries on transient Slack errors. botocore already bundles urllib3, so Slack posts don't
+# need the much larger requests package.
+_HTTP = urllib3.PoolManager(num_pools=1, maxsize=8,
+                            retries=urllib3.Retry(total=3, backoff_factor=0.2,
+                                                  status_forcelist=[429, 500, 502, 503, 504]))
+
+# The message headers and the constant parts of the request never change, so build them once at import
+_ERROR_HEADER = '*Prometheus Instance Not Responding*\n' \
+                'A Prometheus instance has not checked in for over 5 minutes\n'
+_RECOVERY_HEADER = '*Prometheus Instance Recovered*\n' \
+                   'A Prometheus instances has recovered\n'
+_SLACK_BASE = {
+    'channel': SLACK_CHANNEL
+}
+_SLACK_HEADERS = {
+    'Content-Type': 'application/json',
+    'Authorization': f'Bearer {SLACK_TOKEN}'
+}
+
+SCALE_DOWN_CLUSTERS = frozenset()
 SCALE_UP_CRON = ""
 SCALE_DOWN_CRON = ""
 if 'SCALE_DOWN_CLUSTERS' in os.environ:
@@ -46,94 +85,147 @@ if 'SCALE_DOWN_CLUSTERS' in os.environ:
         logger.error('SCALE_DOWN_CRON is a required environment variable if SCALED_DOWN_CLUSTERS set')
         sys.exit(1)
 
-    SCALE_DOWN_CLUSTERS.extend(os.environ['SCALE_DOWN_CLUSTERS'].split(","))
+    SCALE_DOWN_CLUSTERS = frozenset(os.environ['SCALE_DOWN_CLUSTERS'].split(","))
     SCALE_UP_CRON = os.environ['SCALE_UP_CRON']
     SCALE_DOWN_CRON = os.environ['SCALE_DOWN_CRON']
 
+# The cron expressions are immutable env vars, so validate them once at import instead of on every invocation
+_CRON_VALID = bool(SCALE_DOWN_CLUSTERS) and croniter.is_valid(SCALE_DOWN_CRON) and croniter.is_valid(SCALE_UP_CRON)
+if SCALE_DOWN_CLUSTERS and not _CRON_VALID:
+    logger.warning('Cron expression invalid. Processing all clusters as normal.')
 
-def check_cluster_cron(cluster_name):
-    """
-    Returns False if the cluster is scaled down according to configured variables. Otherwise True.
+# Last seen error state per cluster. On a warm Lambda container this lets us skip repeat alerts for clusters whose
+# state hasn't changed since the previous tick; DynamoDB stays authoritative, so a cold start simply reseeds the
+# cache from its first scan.
+_STATE_CACHE = {}
 
-    :param cluster_name: (str) The name of the cluster to use
-    :return: Whether or not we should process the cluster
+
+def scale_down_active():
     """
-    # Process as normal if the cluster isn't in the cluster list
-    if cluster_name not in SCALE_DOWN_CLUSTERS:
-        return True
+    Returns True if the scale down window is currently active according to the configured cron expressions. The
+    answer is the same for every cluster in SCALE_DOWN_CLUSTERS, so check() computes it once per invocation rather
+    than once per cluster.
 
-    # If the cron expressions are invalid process the cluster
-    if not croniter.is_valid(SCALE_DOWN_CRON) or not croniter.is_valid(SCALE_UP_CRON):
-        logger.warning(f"Cron expression invalid. Processing {cluster_name} as normal.")
-        return True
+    :return: Whether the scale down window is currently active
+    """
+    # Process all clusters as normal if no cluster list is configured or the cron expressions failed validation
+    if not _CRON_VALID:
+        return False
 
-    # If the cluster scaled down then don't process the cluster
     now = datetime.now()
     last_scale_down = croniter(SCALE_DOWN_CRON, now).get_prev(datetime)
     last_scale_up = croniter(SCALE_UP_CRON, now).get_prev(datetime)
-    if last_scale_down > last_scale_up:
-        logger.info(f"Cluster {cluster_name} is scaled down. Not processing.")
-        return False
+    return last_scale_down > last_scale_up
+
+
+def _build_should_process():
+    """
+    Builds the per-invocation predicate deciding whether a cluster should be processed. Outside the scale down
+    window every cluster passes, so the hot loop pays for at most one set membership test per cluster.
 
-    logger.info(f"Cluster {cluster_name} is scaled up. Processing as normal.")
-    return True
+    :return: A callable taking a cluster name and returning whether to process it
+    """
+    if not scale_down_active():
+        return lambda cluster_name: True
+    return lambda cluster_name: cluster_name not in SCALE_DOWN_CLUSTERS
+
+
+def _deserialize(item):
+    """
+    Converts a low-level DynamoDB attribute map into a plain dict.
+
+    :param item: (map) The item as returned by the low-level client
+    :return: The item as a plain dict
+    """
+    return {key: _DESERIALIZER.deserialize(value) for key, value in item.items()}
+
+
+# Marks the end of a segment's output on the scan queue
+_SEGMENT_DONE = object()
 
 
-def dynamodb_scan(table_name):
+def _scan_segment(table_name, cutoff, segment, items):
     """
-    Returns the full list of clusters in the DynamoDB table and the last time they checked in (seconds since epoch)
+    Scans a single Parallel Scan segment and puts the deserialized items on the shared queue. The scan filters
+    server-side for clusters that are either stale or still flagged in error, so healthy unchanged rows are never
+    transferred.
 
     :param table_name: (str) The name of the DynamoDB table to use
-    :return: The list of clusters in the DynamoDB table
+    :param cutoff: (int) Epoch seconds before which a cluster counts as stale
+    :param segment: (int) Which Parallel Scan segment this worker is responsible for
+    :param items: (queue.Queue) The queue shared with the consumer
     """
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
-    scan_kwargs = {
-        'ProjectionExpression': "cluster_name, epoch_seconds, error_state"
-    }
+    paginator = _DDB_CLIENT.get_paginator('scan')
+    try:
+        pages = paginator.paginate(
+            TableName=table_name,
+            ProjectionExpression="cluster_name, epoch_seconds, error_state",
+            FilterExpression="epoch_seconds < :cutoff OR error_state = :t",
+            ExpressionAttributeValues={':cutoff': {'N': str(cutoff)}, ':t': {'BOOL': True}},
+            Segment=segment,
+            TotalSegments=TOTAL_SEGMENTS,
+            # Eventual consistency is fine for a 5 minute staleness check; a small page keeps each round-trip cheap
+            # and gets the first items to the consumer sooner
+            ConsistentRead=False,
+            PaginationConfig={'PageSize': 200}
+        )
+        for page in pages:
+            for item in page['Items']:
+                items.put(_deserialize(item))
+    finally:
+        items.put(_SEGMENT_DONE)
+
+
+def dynamodb_scan(cutoff, table_name=ENVIRONMENT_NAME):
+    """
+    Yields the clusters in the DynamoDB table that need attention: those which last checked in before the cutoff and
+    those still flagged in error. The table is read as a Parallel Scan with one thread per segment, and items are
+    yielded as soon as a segment returns them so processing overlaps with scanning.
+
+    :param cutoff: (int) Epoch seconds before which a cluster counts as stale
+    :param table_name: (str) The name of the DynamoDB table to use
+    :return: A generator over the clusters needing attention
+    """
+    items = queue.Queue()
+    with ThreadPoolExecutor(max_workers=TOTAL_SEGMENTS) as executor:
+        futures = [executor.submit(_scan_segment, table_name, cutoff, segment, items)
+                   for segment in range(TOTAL_SEGMENTS)]
+
+        segments_remaining = TOTAL_SEGMENTS
+        while segments_remaining:
+            item = items.get()
+            if item is _SEGMENT_DONE:
+                segments_remaining -= 1
+            else:
+                yield item
 
-    dynamodb_records = []
-    done = False
-    start_key = None
     try:
-        while not done:
-            if start_key:
-                scan_kwargs['ExclusiveStartKey'] = start_key
-            response = table.scan(**scan_kwargs)
-            dynamodb_records.extend(response.get('Items', []))
-            start_key = response.get('LastEvaluatedKey', None)
-            done = start_key is None
+        for future in futures:
+            future.result()
     except ClientError as err:
         logger.critical('DynamoDB Scan Encountered an Error')
         logger.critical(err, exc_info=True)
         sys.exit(1)
-    else:
-        return dynamodb_records
 
 
-def dynamodb_update(table_name, cluster_name, error_state):
+def dynamodb_batch_update(state_updates, table=_TABLE):
     """
-    Updates the error_state field in DynamoDB for a cluster so we know whether an alert has previously been sent.
+    Writes the new error_state for a batch of clusters in one BatchWriteItem pass so we know whether an alert has
+    previously been sent, without issuing one request per cluster.
 
-    :param table_name: (str) The name of the DynamoDB table to use
-    :param cluster_name: (str) The name of the Kubernetes cluster running Prometheus
-    :param error_state: (bool) Whether the cluster is in an error state
+    :param state_updates: (list) Tuples of (cluster, error_state) where cluster is the scanned item
+    :param table: The DynamoDB Table to use, defaults to the module-level handle
     """
-    dynamodb = boto3.resource('dynamodb')
     try:
-        table = dynamodb.Table(table_name)
-        table.update_item(
-            Key={
-                'cluster_name': cluster_name
-            },
-            UpdateExpression="set error_state=:e",
-            ExpressionAttributeValues={
-                ':e': error_state
-            },
-            ReturnValues="UPDATED_NEW"
-        )
+        with table.batch_writer() as batch:
+            for cluster, error_state in state_updates:
+                batch.put_item(Item={
+                    'cluster_name': cluster['cluster_name'],
+                    'epoch_seconds': cluster['epoch_seconds'],
+                    'error_state': error_state
+                })
     except ClientError as err:
-        logger.warning('DynamoDB Update Encountered an Error')
+        logger.warning('DynamoDB Batch Update Encountered an Error')
         logger.warning(err, exc_info=True)
 
 
@@ -144,35 +236,39 @@ def send_slack_notification(notification_text, error=True):
     :param notification_text: (str) The text to include in the message
     :param error: (bool) Whether this is an error alert or a recovery
     """
-    if error:
-        slack_text = '*Prometheus Instance Not Responding*\n' \
-                     'A Prometheus instance has not checked in for over 5 minutes\n' \
-                     + notification_text
-    else:
-        slack_text = '*Prometheus Instance Recovered*\n' \
-                     'A Prometheus instances has recovered\n' \
-                     + notification_text
-
-    json_message = {
-        'token': SLACK_TOKEN,
-        'channel': SLACK_CHANNEL,
-        'text': slack_text
-    }
+    json_message = {**_SLACK_BASE, 'text': (_ERROR_HEADER if error else _RECOVERY_HEADER) + notification_text}
 
     try:
-        slack_response = requests.post('https://slack.com/api/chat.postMessage', json_message)
-        slack_response.raise_for_status()
+        slack_response = _HTTP.request('POST', 'https://slack.com/api/chat.postMessage',
+                                       body=json.dumps(json_message).encode(),
+                                       headers=_SLACK_HEADERS, timeout=5.0)
+        if slack_response.status >= 400:
+            raise urllib3.exceptions.HTTPError(f'Slack returned status {slack_response.status}')
 
-        if not slack_response.json()["ok"]:
+        if not json.loads(slack_response.data)["ok"]:
             logger.error('Received an error from slack!')
-            logger.error(slack_response.text)
-            raise requests.RequestException
+            logger.error(slack_response.data)
+            raise urllib3.exceptions.HTTPError('Slack API returned an error')
 
-    except requests.RequestException as err:
+    except urllib3.exceptions.HTTPError as err:
         logger.error('Post to Slack API encountered an error')
         logger.error(err, exc_info=True)
 
 
+def _log_cluster(cluster_name, time_since_check_in, state):
+    """
+    Emits one compact single-line JSON log for a cluster, keeping CloudWatch Logs ingest small and easy to query
+    with Logs Insights.
+
+    :param cluster_name: (str) The name of the Kubernetes cluster running Prometheus
+    :param time_since_check_in: (int) Seconds since the cluster last checked in
+    :param state: (str) The state the checker put the cluster in: 'ok', 'error' or 'scaled_down'
+    """
+    level = logging.ERROR if state == 'error' else logging.INFO
+    logger.log(level, json.dumps({'c': cluster_name, 't': int(time_since_check_in), 's': state},
+                                 separators=(',', ':')))
+
+
 def check(event, context):
     """
     The Lambda handler. Queries DynamoDB, iterates over the returned clusters and sends Slack messages if they have
@@ -181,28 +277,50 @@ def check(event, context):
     :param event: (map) The Lambda event
     :param context: (map) The Lambda context
     """
-    clusters = dynamodb_scan(ENVIRONMENT_NAME)
-
-    for cluster in clusters:
-        now = int(time.time())
+    error_lines = []
+    recovery_lines = []
+    state_updates = []
+    should_process = _build_should_process()
+    # Integer nanoseconds divided down to whole seconds; second granularity is plenty for a 5 minute staleness check
+    now = time.time_ns() // 1_000_000_000
+
+    # The scan only returns clusters that are stale or still flagged in error; healthy unchanged clusters are
+    # filtered out server-side
+    for cluster in dynamodb_scan(now - MAX_TIME_SECONDS):
         cluster_name = cluster['cluster_name']
-        if not check_cluster_cron(cluster_name):
-            continue
-
         time_since_check_in = now - cluster['epoch_seconds']
+        if not should_process(cluster_name):
+            _log_cluster(cluster_name, time_since_check_in, 'scaled_down')
+            continue
 
-        if time_since_check_in > int(MAX_TIME_SECONDS):
-            logger.error(f'Time since {cluster_name} checked in is {time_since_check_in} seconds')
-            logger.info(f'Sending alert Slack notification for {cluster_name}')
-            send_slack_notification(f'Time since {cluster_name} checked in is {time_since_check_in} seconds')
-            dynamodb_update(ENVIRONMENT_NAME, cluster_name, True)
+        if time_since_check_in > MAX_TIME_SECONDS:
+            _log_cluster(cluster_name, time_since_check_in, 'error')
+            if _STATE_CACHE.get(cluster_name) is not True:
+                error_lines.append(f'• Time since {cluster_name} checked in is {time_since_check_in} seconds')
+            # Gate the write on the stored state alone, not the cache, so a failed write is retried next tick
+            if not cluster.get('error_state'):
+                state_updates.append((cluster, True))
+            _STATE_CACHE[cluster_name] = True
         else:
-            logger.info(f'Time since {cluster_name} checked in is {time_since_check_in} seconds')
-            if 'error_state' in cluster and cluster['error_state']:
-                logger.info(f'Sending recovery Slack notification for {cluster_name}')
-                send_slack_notification(f'Time since {cluster_name} checked in is {time_since_check_in} seconds',
-                                        error=False)
-            dynamodb_update(ENVIRONMENT_NAME, cluster_name, False)
+            _log_cluster(cluster_name, time_since_check_in, 'ok')
+            if cluster.get('error_state'):
+                recovery_lines.append(f'• Time since {cluster_name} checked in is {time_since_check_in} seconds')
+                state_updates.append((cluster, False))
+            _STATE_CACHE[cluster_name] = False
+
+    # The Slack posts and the batch write are independent, so run them concurrently instead of back to back
+    tasks = []
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        if error_lines:
+            logger.info('Sending alert Slack notification for %d clusters', len(error_lines))
+            tasks.append(executor.submit(send_slack_notification, '\n'.join(error_lines)))
+        if recovery_lines:
+            logger.info('Sending recovery Slack notification for %d clusters', len(recovery_lines))
+            tasks.append(executor.submit(send_slack_notification, '\n'.join(recovery_lines), error=False))
+        if state_updates:
+            tasks.append(executor.submit(dynamodb_batch_update, state_updates))
+    for task in tasks:
+        task.result()
 
 
 if __name__ == "__main__":